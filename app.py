@@ -5,15 +5,66 @@ Created on Thu Jun 26 10:26:20 2025
 
 # Importation des bibliothèques nécessaires
 import streamlit as st  # Pour créer l'interface web
-import json             # Pour manipuler le format GeoJSON
-import pandas as pd     # Pour créer le tableau Excel
-from shapely.geometry import shape, Polygon, MultiPolygon, mapping  # Pour manipuler les géométries
-from shapely.ops import transform  # Pour reprojeter les géométries
+import math             # Pour la recherche de la tolérance de simplification
+import numpy as np      # Pour manipuler les coordonnées sous forme de tableaux
+import ijson            # Pour lire le GeoJSON en flux, entité par entité
+import orjson           # Pour sérialiser rapidement les propriétés en JSON
+import shapely          # Pour les opérations groupées sur les géométries (reprojection)
+from shapely.geometry import shape, Polygon  # Pour manipuler les géométries
 from pyproj import Transformer, CRS  # Pour gérer les systèmes de coordonnées
-import fiona  # Pour lire les fichiers GeoJSON avec leurs métadonnées
-import tempfile  # Pour créer des fichiers temporaires
+import xlsxwriter  # Pour écrire le fichier Excel
+import os  # Pour connaître le nombre de processeurs
+from concurrent.futures import Future, ThreadPoolExecutor  # Pour simplifier les polygones en parallèle
+from itertools import islice  # Pour découper la lecture des entités en paquets
 from io import BytesIO  # Pour manipuler des fichiers en mémoire (Excel, GeoJSON)
 
+# Nombre maximal de points par polygone, pour rester sous la limite de caractères d’une cellule Excel
+TARGET_POINTS = 780
+
+# Limite de caractères d’une cellule Excel, et longueur maximale de la géométrie sérialisée
+# dans la cellule (qui l'entoure de {"type":"Feature","geometry":...})
+EXCEL_CELL_MAX_CHARS = 32767
+MAX_GEOMETRY_CHARS = EXCEL_CELL_MAX_CHARS - len('{"type":"Feature","geometry":}')
+
+# Nombre d'entités lues et traitées ensemble lors de la lecture en flux du GeoJSON
+CHUNK_SIZE = 1000
+
+# Préfixe ijson des entités, selon le type de l'objet GeoJSON lu : une collection d'entités, ou une entité seule
+FEATURE_PREFIXES = {
+    "FeatureCollection": "features.item",
+    "Feature": "",
+}
+
+# Colonnes ajoutées par la conversion à la fin du tableau Excel : elles remplacent les attributs de même nom
+COMPUTED_COLUMNS = ["geometry", "simplification_info"]
+
+# Nom du CRS déclaré par le membre "crs" du GeoJSON, sous sa forme nommée
+# ({"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::2154"}}) ou sous l'ancienne forme
+# ({"type": "EPSG", "properties": {"code": 2154}}). Un membre illisible lève une erreur, plutôt que
+# de supposer à tort des coordonnées en WGS 84
+def read_crs_name(crs):
+    properties = (crs.get("properties") if isinstance(crs, dict) else None) or {}
+    if properties.get("name"):
+        return properties["name"]
+    if str(crs.get("type")).upper() == "EPSG" and properties.get("code") is not None:
+        return f"EPSG:{int(properties['code'])}"
+    raise ValueError(f"CRS illisible dans le membre \"crs\" du GeoJSON : {orjson.dumps(crs).decode('utf-8')}")
+
+# Construction du CRS source à partir de son nom, et test "déjà en WGS 84 ?", mis en cache entre les exécutions
+# du script (Streamlit relance tout le script à chaque interaction). CRS84 est aussi considéré comme du WGS 84,
+# car il ne diffère d'EPSG:4326 que par l'ordre des axes
+@st.cache_resource(max_entries=32)
+def get_source_crs(crs_name):
+    source_crs = CRS.from_user_input(crs_name)
+    return source_crs, source_crs.equals(CRS.from_epsg(4326), ignore_axis_order=True)
+
+# Création du transformateur de coordonnées, mise en cache entre les exécutions du script.
+# La clé est le nom du CRS source, tel que déclaré dans le GeoJSON
+@st.cache_resource
+def get_transformer(crs_name, target_epsg=4326):
+    source_crs, _ = get_source_crs(crs_name)
+    return Transformer.from_crs(source_crs, CRS.from_epsg(target_epsg), always_xy=True)
+
 # Configuration de la page Streamlit
 st.set_page_config(page_title="GeoJSON vers Excel pour Superset", layout="centered")
 
@@ -29,147 +80,321 @@ st.markdown("- sera reprojeté automatiquement en WGS 84 (EPSG:4326), car Supers
 uploaded_file = st.file_uploader("Déposez un fichier GeoJSON", type=["geojson"])
 
 if uploaded_file is not None:
-    # Lire le contenu une seule fois
-    content = uploaded_file.read()
+    # Vérifie que le fichier n'est pas vide, sans le charger en entier (il est ensuite lu en flux)
+    is_empty = not uploaded_file.read(1024).strip()
+    uploaded_file.seek(0)
 
-    if not content.strip():
+    if is_empty:
         st.error("Le fichier est vide. Assurez-vous que ce n'est pas un téléchargement vide.")
     else:
-        uploaded_file.seek(0)  # Au cas où Fiona relit depuis le début
-
-    # Créer un fichier temporaire pour que Fiona puisse le lire
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".geojson") as tmp_input:
-        # Lire le contenu du fichier uploadé et l’écrire dans le fichier temporaire
-        tmp_input.write(content)
-        tmp_input.flush()
-
         try:
-            # Ouverture du GeoJSON avec Fiona (qui permet de lire les métadonnées comme le CRS)
-            with fiona.open(tmp_input.name, 'r') as src:
-                crs_dict = src.crs  # Extraction du système de coordonnées (CRS)
-                features = list(src)  # Liste des entités géographiques
+            # Lecture en flux du GeoJSON avec ijson (sans Fiona/GDAL ni chargement complet du fichier).
+            # Le type de l'objet GeoJSON (collection d'entités ou entité seule) détermine où lire les entités
+            geojson_type = next(ijson.items(uploaded_file, "type"), None)
+            if geojson_type not in FEATURE_PREFIXES:
+                raise ValueError(f"le fichier n'est ni une FeatureCollection ni une Feature GeoJSON (type : {geojson_type})")
+            features_prefix = FEATURE_PREFIXES[geojson_type]
+
+            # Extraction du système de coordonnées (CRS) déclaré dans le membre "crs", seul construit en mémoire
+            uploaded_file.seek(0)
+            crs = next(ijson.items(uploaded_file, "crs", use_float=True), None)
 
-            # Si aucun CRS n’est défini, on suppose EPSG:4326 (WGS 84)
-            if not crs_dict:
+            # Si aucun CRS n’est défini, on suppose EPSG:4326 (WGS 84), comme le prévoit la RFC 7946
+            if crs is None:
                 st.warning("CRS non détecté, utilisation par défaut : EPSG:4326")
-                source_crs = CRS.from_epsg(4326)
+                is_wgs84 = True
             else:
-                source_crs = CRS.from_user_input(crs_dict)
+                crs_name = read_crs_name(crs)
+                source_crs, is_wgs84 = get_source_crs(crs_name)
                 st.success(f"CRS détecté : {source_crs.to_string()}")
 
-            # Définition du CRS cible : WGS 84 (EPSG:4326)
-            target_crs = CRS.from_epsg(4326)
-            transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
+            # Si les données sont déjà en WGS 84 (EPSG:4326), aucune reprojection n'est nécessaire
+            # (ni transformateur à créer)
+            if is_wgs84:
+                reproject = None
+            else:
+                # Transformateur vers le CRS cible : WGS 84 (EPSG:4326)
+                transformer = get_transformer(crs_name)
+
+                # Fonction de reprojection : toutes les coordonnées sont envoyées
+                # en un seul appel à PROJ (et non point par point)
+                def reproject(coords):
+                    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+                    return np.column_stack([x, y])
+
+            # Extrait les anneaux de chaque polygone d'une géométrie GeoJSON sous forme de tableaux numpy
+            # (les MultiPolygon sont éclatés en plusieurs Polygons, les anneaux vides sont ignorés).
+            # Retourne None pour les autres géométries
+            def extract_polygon_rings(geometry):
+                if geometry["type"] == "Polygon":
+                    # Un polygone sans coordonnées (ou dont l'anneau extérieur est vide) est conservé, comme polygone vide
+                    rings = geometry["coordinates"]
+                    parts = [rings if rings and rings[0] else []]
+                elif geometry["type"] == "MultiPolygon":
+                    # Les parties vides d'un multipolygone sont ignorées
+                    parts = [rings for rings in geometry["coordinates"] if rings and rings[0]]
+                else:
+                    return None
+                polygons_rings = [[np.asarray(ring, dtype=float)[:, :2] for ring in rings if ring] for rings in parts]
+                if any(len(ring) < 4 for rings in polygons_rings for ring in rings):
+                    raise ValueError("un anneau de polygone doit contenir au moins 4 points")
+                return polygons_rings
 
-            # Fonction de reprojection d'une géométrie
-            def reproject(geom):
-                return transform(transformer.transform, geom)
+            # Construit tous les polygones en un seul appel shapely, après reprojection groupée des coordonnées
+            def build_polygons(rings_per_polygon):
+                # Les polygones sans anneau restent des polygones vides
+                polys = np.full(len(rings_per_polygon), Polygon(), dtype=object)
+                rings = [ring for polygon_rings in rings_per_polygon for ring in polygon_rings]
+                if not rings:
+                    return polys
+                coords = np.concatenate(rings)
+                if reproject is not None:
+                    coords = reproject(coords)
+                ring_indices = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+                polygon_indices = np.repeat(np.arange(len(rings_per_polygon)), [len(r) for r in rings_per_polygon])
+                return shapely.polygons(shapely.linearrings(coords, indices=ring_indices), indices=polygon_indices, out=polys)
 
-            # Compte le nombre total de points dans un polygone
+            # Compte le nombre total de points dans un polygone (comptage fait directement par GEOS)
             def total_coords_count(geom):
                 if isinstance(geom, Polygon):
-                    rings = [geom.exterior] + list(geom.interiors)
-                    return sum(len(ring.coords) for ring in rings)
+                    return int(shapely.get_num_coordinates(geom))
                 return 0
 
+            # Recherche dichotomique (sur l'échelle logarithmique), entre low et high, de la plus petite tolérance
+            # qui passe sous la cible, arrêtée dès que l'on est à moins de 10 % de celle-ci. Si la simplification
+            # à la tolérance high ne passe pas sous la cible, elle est retournée telle quelle
+            def search_tolerance(geom, low, high, target_points, max_iterations, preserve_topology):
+                tolerance = high
+                simplified = geom.simplify(tolerance, preserve_topology=preserve_topology)
+                simplified_n = int(shapely.get_num_coordinates(simplified))
+                for _ in range(max_iterations):
+                    if simplified_n >= 0.9 * target_points:
+                        break
+                    candidate_tolerance = math.sqrt(low * high)  # milieu sur l'échelle logarithmique
+                    candidate = geom.simplify(candidate_tolerance, preserve_topology=preserve_topology)
+                    candidate_n = int(shapely.get_num_coordinates(candidate))
+                    if candidate_n > target_points:
+                        low = candidate_tolerance
+                    else:
+                        high = candidate_tolerance
+                        tolerance, simplified, simplified_n = candidate_tolerance, candidate, candidate_n
+                    if high / low < 1 + 1e-6:
+                        break
+                return simplified, tolerance, simplified_n
+
             # Simplifivation adaptative d’un polygone jusqu'à atteindre un certain nombre de points
-            def adaptive_polygon_simplify(geom, target_points=780, max_iterations=300):
-                original = total_coords_count(geom)
+            # (recherche dichotomique de la tolérance, entre une valeur très faible et la diagonale de l'emprise)
+            # Le nombre de points d'origine peut être fourni s'il est déjà connu, pour éviter de le recompter
+            def adaptive_polygon_simplify(geom, target_points=TARGET_POINTS, max_iterations=50, original=None):
+                if original is None:
+                    original = total_coords_count(geom)
                 if original <= target_points:
                     return geom, 0.0, original, original
 
-                tolerance = 1e-10  # Tolérance initiale très faible
-                simplified = geom.simplify(tolerance, preserve_topology=True)
-                iteration = 0
+                minx, miny, maxx, maxy = geom.bounds
+                diagonal = max(math.hypot(maxx - minx, maxy - miny), 1e-10)
 
-                while total_coords_count(simplified) > target_points and iteration < max_iterations:
-                    error_ratio = total_coords_count(simplified) / target_points
-                    tolerance *= min(error_ratio, 2)
+                if geom.is_valid:
+                    # Recherche avec le Douglas-Peucker simple de GEOS, bien plus rapide que la version qui préserve
+                    # la topologie, puis simplification finale en préservant la topologie avec la tolérance trouvée.
+                    # Si elle garde plus de points que la cible, la recherche reprend jusqu'à la diagonale
+                    _, tolerance, _ = search_tolerance(geom, 1e-10, diagonal, target_points, max_iterations, preserve_topology=False)
                     simplified = geom.simplify(tolerance, preserve_topology=True)
-                    iteration += 1
+                    simplified_n = total_coords_count(simplified)
+                    if simplified_n > target_points:
+                        simplified, tolerance, simplified_n = search_tolerance(
+                            geom, tolerance, diagonal, target_points, max_iterations, preserve_topology=True)
+                else:
+                    # Sur un polygone invalide, GEOS répare le résultat du Douglas-Peucker simple, qui peut garder
+                    # plus de points que l'original : la recherche préserve directement la topologie
+                    simplified, tolerance, simplified_n = search_tolerance(
+                        geom, 1e-10, diagonal, target_points, max_iterations, preserve_topology=True)
 
-                simplified_n = total_coords_count(simplified)
                 return simplified, tolerance, original, simplified_n
 
-            # Préparation des listes de données pour Excel et GeoJSON
-            all_records = []
-            simplified_features = []
-
-            # Parcours de chaque entité géographique du fichier
-            for i, feature in enumerate(features):
-                if feature is None:
-                    st.warning(f"L'entité #{i} est vide (None). Elle est ignorée.")
-                    continue
-
-                # Nouvelles vérifications explicites
-                if "geometry" not in feature:
-                    st.error(f"L'entité #{i} ne contient pas de clé 'geometry'.")
-                    continue
-                if "properties" not in feature:
-                    st.error(f"L'entité #{i} ne contient pas de clé 'properties'.")
-                    continue
-                if feature.get("geometry") is None:
-                    st.warning(f"L'entité #{i} a une géométrie nulle. Elle est ignorée.")
-                    continue
-                if not feature.get("properties"):
-                    st.warning(f"L'entité #{i} n'a pas de propriété. Elle est traitée sans attribut.")
-
-                try:
-                    # Récupération sécurisée des propriétés
-                    raw_props = feature.get("properties") or {}
-                    props = dict(raw_props)
-
-                    # Conversion de la géométrie au format shapely + reprojection
-                    geom = shape(feature["geometry"])
-                    geom = reproject(geom)
-
-                    # Éclatement des MultiPolygon en plusieurs Polygons
-                    polys = list(geom.geoms) if isinstance(geom, MultiPolygon) else [geom]
-
-                    for poly in polys:
-                        simplified_geom, tol, orig_pts, simp_pts = adaptive_polygon_simplify(poly)
-                        geom_json = mapping(simplified_geom)
-
-                        simplified_features.append({
-                            "type": "Feature",
-                            "geometry": geom_json,
-                            "properties": props
-                        })
-
-                        record = props.copy()
-                        record_geojson = {
-                            "type": "Feature",
-                            "geometry": geom_json
-                        }
-                        record["geometry"] = json.dumps(record_geojson, ensure_ascii=False, separators=(',', ':'))
-                        record["simplification_info"] = (
-                            f"{orig_pts}→{simp_pts} points (tolérance={tol:.0e})"
-                            if tol > 0 else "Aucune simplification"
-                        )
-
-                        all_records.append(record)
-
-                except Exception as sub_e:
-                    st.error(f"Erreur avec l'entité #{i} : {sub_e}")
-
-            # Création d’un fichier Excel à partir des enregistrements
-            df = pd.DataFrame(all_records)
+            # Simplifie un polygone puis sérialise sa géométrie en GeoJSON compact (appelée dans un thread).
+            # La géométrie n'est sérialisée qu'une fois, pour le GeoJSON simplifié et pour Excel
+            def simplify_and_serialize(poly, n_points):
+                simplified_geom, tol, orig_pts, simp_pts = adaptive_polygon_simplify(poly, original=int(n_points))
+                return shapely.to_geojson(simplified_geom), tol, orig_pts, simp_pts
+
+            # Crée le tableau Excel avec xlsxwriter en mode "constant_memory" et écrit son en-tête : les lignes sont
+            # ensuite écrites dans l'ordre et vidées au fil de l'eau, textes écrits directement dans la cellule
+            # (sans table de chaînes partagées)
+            def create_excel_sheet(output, columns):
+                workbook = xlsxwriter.Workbook(output, {
+                    "constant_memory": True,
+                    "strings_to_urls": False,  # évite de rechercher des URL dans chaque géométrie
+                    "use_zip64": True,
+                })
+                sheet = workbook.add_worksheet("Sheet1")
+
+                # En-tête en gras, comme avec pandas
+                sheet.write_row(0, 0, columns, workbook.add_format({"bold": True}))
+                return workbook, sheet
+
+            # Écrit une ligne du tableau Excel cellule par cellule (write_row s'arrête à la première cellule en erreur
+            # et laisse les suivantes vides). Retourne les colonnes dont le texte, trop long pour une cellule, a été tronqué
+            def write_excel_row(sheet, row_index, values, columns):
+                truncated = []
+                for col, value in enumerate(values):
+                    if sheet.write(row_index, col, value) == -2:
+                        truncated.append(columns[col])
+                return truncated
+
+            # Valeur d'un attribut pour une cellule Excel : les valeurs imbriquées (objets, listes),
+            # non gérées par xlsxwriter, sont écrites en JSON compact
+            def excel_value(value):
+                if isinstance(value, (dict, list)):
+                    return orjson.dumps(value).decode("utf-8")
+                return value
+
+            # Indique si une entité donne au moins une ligne, selon les mêmes vérifications que la première passe
+            # ci-dessous (les multipolygones dont toutes les parties sont vides ne donnent aucune ligne)
+            def has_rows(feature):
+                if not isinstance(feature, dict) or "properties" not in feature or feature.get("geometry") is None:
+                    return False
+                geometry = feature["geometry"]
+                if geometry.get("type") == "MultiPolygon":
+                    return any(rings and rings[0] for rings in geometry["coordinates"])
+                return True
+
+            # Noms des attributs des entités exportées, dans leur ordre d'apparition : ils forment l'en-tête
+            # du tableau Excel, écrit avant les lignes (entités lues en flux, une seule à la fois en mémoire)
+            uploaded_file.seek(0)
+            property_names = {}
+            for feature in ijson.items(uploaded_file, features_prefix, use_float=True):
+                raw_props = feature.get("properties") if has_rows(feature) else None
+                if isinstance(raw_props, dict):
+                    property_names.update(dict.fromkeys(raw_props))
+            property_names = [name for name in property_names if name not in COMPUTED_COLUMNS]
+
+            # Préparation du tableau Excel et du GeoJSON simplifié, tous deux écrits au fil de l'eau
+            # (le GeoJSON sans indentation)
             excel_buffer = BytesIO()
-            df.to_excel(excel_buffer, index=False, engine='openpyxl')
+            columns = property_names + COMPUTED_COLUMNS
+            workbook, sheet = create_excel_sheet(excel_buffer, columns)
+            geojson_buffer = BytesIO()
+            geojson_buffer.write(b'{"type":"FeatureCollection","features":[')
+            n_features = 0
+
+            # Les entités sont lues en flux et traitées par paquets de CHUNK_SIZE
+            uploaded_file.seek(0)
+            features = ijson.items(uploaded_file, features_prefix, use_float=True)
+            first_index = 0
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                while chunk := list(islice(features, CHUNK_SIZE)):
+                    # Première passe : vérification de chaque entité et extraction de ses polygones
+                    entries = []            # (indice, propriétés, nombre de polygones) de chaque entité valide
+                    rings_per_polygon = []  # anneaux de chaque polygone, pour la construction groupée
+                    other_geoms = []        # géométries autres que (multi)polygones, conservées telles quelles
+                    for i, feature in enumerate(chunk, start=first_index):
+                        if feature is None:
+                            st.warning(f"L'entité #{i} est vide (None). Elle est ignorée.")
+                            continue
+
+                        # Nouvelles vérifications explicites
+                        if "geometry" not in feature:
+                            st.error(f"L'entité #{i} ne contient pas de clé 'geometry'.")
+                            continue
+                        if "properties" not in feature:
+                            st.error(f"L'entité #{i} ne contient pas de clé 'properties'.")
+                            continue
+                        if feature.get("geometry") is None:
+                            st.warning(f"L'entité #{i} a une géométrie nulle. Elle est ignorée.")
+                            continue
+                        if not feature.get("properties"):
+                            st.warning(f"L'entité #{i} n'a pas de propriété. Elle est traitée sans attribut.")
+
+                        try:
+                            # Récupération sécurisée des propriétés
+                            raw_props = feature.get("properties") or {}
+                            props = dict(raw_props)
+
+                            # Extraction des anneaux des polygones
+                            polygons_rings = extract_polygon_rings(feature["geometry"])
+                            if polygons_rings is None:
+                                other_geoms.append(shape(feature["geometry"]))
+                                entries.append((i, props, None))
+                            else:
+                                rings_per_polygon.extend(polygons_rings)
+                                entries.append((i, props, len(polygons_rings)))
+
+                        except Exception as sub_e:
+                            st.error(f"Erreur avec l'entité #{i} : {sub_e}")
+                    first_index += len(chunk)
+
+                    # Construction groupée des polygones du paquet et reprojection des autres géométries
+                    polys = build_polygons(rings_per_polygon)
+                    point_counts = shapely.get_num_coordinates(polys)
+                    if reproject is not None:
+                        other_geoms = shapely.transform(other_geoms, reproject)
+
+                    # Les polygones et les autres géométries sont sérialisés en un seul appel shapely pour chaque groupe.
+                    # Les polygones dont la géométrie tient déjà dans une cellule Excel sont gardés tels quels
+                    geom_strs = shapely.to_geojson(polys)
+                    polys_iter = iter(zip(polys, point_counts, geom_strs))
+                    others_iter = iter(shapely.to_geojson(other_geoms))
+
+                    # Seconde passe : simplification en parallèle des polygones trop longs pour une cellule Excel
+                    # (shapely libère le GIL pendant les calculs GEOS, des threads suffisent)
+                    jobs = []
+                    for i, props, n_polys in entries:
+                        if n_polys is None:
+                            results = [(next(others_iter), 0.0, 0, 0)]
+                        else:
+                            results = []
+                            for _ in range(n_polys):
+                                poly, n_points, geom_str = next(polys_iter)
+                                if len(geom_str) <= MAX_GEOMETRY_CHARS:
+                                    results.append((geom_str, 0.0, n_points, n_points))
+                                else:
+                                    results.append(executor.submit(simplify_and_serialize, poly, n_points))
+                        jobs.append((i, props, results))
+
+                    # Récupération des résultats dans l'ordre des entités (les messages Streamlit restent dans le thread principal)
+                    for i, props, results in jobs:
+                        try:
+                            # Propriétés sérialisées une seule fois par entité, partagées par tous ses polygones
+                            # (les attributs absents du tableau Excel donnent des cellules vides)
+                            props_json = orjson.dumps(props)
+                            props_row = [excel_value(props.get(name)) for name in property_names]
+                            for result in results:
+                                geom_str, tol, orig_pts, simp_pts = result.result() if isinstance(result, Future) else result
+
+                                # Ligne du tableau Excel, préparée avant toute écriture pour que les deux fichiers restent alignés
+                                row = props_row + [
+                                    '{"type":"Feature","geometry":' + geom_str + '}',
+                                    f"{orig_pts}→{simp_pts} points (tolérance={tol:.0e})"
+                                    if tol > 0 else "Aucune simplification",
+                                ]
+
+                                if n_features > 0:
+                                    geojson_buffer.write(b",")
+                                geojson_buffer.write(b'{"type":"Feature","geometry":' + geom_str.encode("utf-8")
+                                                     + b',"properties":' + props_json + b'}')
+
+                                n_features += 1
+                                truncated = write_excel_row(sheet, n_features, row, columns)
+                                if truncated:
+                                    st.warning(f"L'entité #{i} : texte tronqué à {EXCEL_CELL_MAX_CHARS} caractères "
+                                               f"dans le fichier Excel (colonnes : {', '.join(truncated)}).")
+
+                        except Exception as sub_e:
+                            st.error(f"Erreur avec l'entité #{i} : {sub_e}")
+
+            # Fin du fichier Excel
+            workbook.close()
             excel_buffer.seek(0)
 
-            # Création d’un GeoJSON simplifié
-            final_geojson = {
-                "type": "FeatureCollection",
-                "features": simplified_features
-            }
-            geojson_str = json.dumps(final_geojson, ensure_ascii=False, indent=2)
-            geojson_bytes = geojson_str.encode("utf-8")
+            # Fin du GeoJSON simplifié
+            geojson_buffer.write(b']}')
+            geojson_buffer.seek(0)
 
             # Affichage des boutons de téléchargement
             st.success("Conversion réussie. Fichiers prêts à être téléchargés :")
             st.download_button("Télécharger Excel (.xlsx)", data=excel_buffer, file_name="superset_ready.xlsx")
-            st.download_button("Télécharger GeoJSON simplifié", data=geojson_bytes, file_name="simplified.geojson")
+            st.download_button("Télécharger GeoJSON simplifié", data=geojson_buffer, file_name="simplified.geojson")
 
         except Exception as e:
             # En cas d'erreur quelconque, afficher le message d'erreur
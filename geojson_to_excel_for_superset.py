@@ -2,147 +2,349 @@
 # Objectif : préparer les données pour Superset (deck.gl), en reprojetant,
 # simplifiant et éclatant les multipolygones.
 
-import json
-import pandas as pd
-from shapely.geometry import shape, Polygon, MultiPolygon, mapping
-from shapely.ops import transform
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import ijson
+import numpy as np
+import orjson
+import shapely
+from shapely.geometry import Polygon
 from pyproj import Transformer, CRS
-import fiona  # pour lire les fichiers GeoJSON avec détection automatique du CRS
-
-# Fonction qui lit un fichier GeoJSON et récupère :
-# -la liste des entités géographiques (features)
-# -le système de projection (CRS) détecté
-def read_features_and_crs(input_geojson_path):
-    with fiona.open(input_geojson_path, 'r') as src:
-        crs_dict = src.crs  # extraction du CRS (système de coordonnées)
-        if not crs_dict:
-            # Si le CRS est absent, on suppose qu'il est déjà en WGS 84
-            print("CRS inconnu. Supposition : EPSG:4326")
-            source_crs = CRS.from_epsg(4326)
-        else:
-            # Conversion du CRS au format pyproj
-            source_crs = CRS.from_user_input(crs_dict)
-            print(f"CRS détecté : {source_crs.to_string()}")
+import xlsxwriter
+
+# Nombre maximal de points par polygone, pour rester sous la limite de caractères d’une cellule Excel
+TARGET_POINTS = 780
+
+# Limite de caractères d’une cellule Excel, et longueur maximale de la géométrie sérialisée
+# dans la cellule (qui l'entoure de {"type":"Feature","geometry":...})
+EXCEL_CELL_MAX_CHARS = 32767
+MAX_GEOMETRY_CHARS = EXCEL_CELL_MAX_CHARS - len('{"type":"Feature","geometry":}')
+
+# Nombre d'entités lues et traitées ensemble lors de la lecture en flux du GeoJSON
+CHUNK_SIZE = 1000
+
+# Préfixe ijson des entités, selon le type de l'objet GeoJSON lu : une collection d'entités, ou une entité seule
+FEATURE_PREFIXES = {
+    "FeatureCollection": "features.item",
+    "Feature": "",
+}
+
+# Colonnes ajoutées par la conversion à la fin du tableau Excel : elles remplacent les attributs de même nom
+COMPUTED_COLUMNS = ["geometry", "simplification_info"]
+
+# Fonction qui retourne le nom du CRS déclaré par le membre "crs" d'un GeoJSON, sous sa forme nommée
+# ({"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::2154"}}) ou sous l'ancienne forme
+# ({"type": "EPSG", "properties": {"code": 2154}}). Un membre illisible lève une erreur, plutôt que
+# de supposer à tort des coordonnées en WGS 84
+def read_crs_name(crs):
+    properties = (crs.get("properties") if isinstance(crs, dict) else None) or {}
+    if properties.get("name"):
+        return properties["name"]
+    if str(crs.get("type")).upper() == "EPSG" and properties.get("code") is not None:
+        return f"EPSG:{int(properties['code'])}"
+    raise ValueError(f"CRS illisible dans le membre \"crs\" du GeoJSON : {orjson.dumps(crs).decode('utf-8')}")
+
+# Fonction qui lit le système de projection (CRS) déclaré dans le membre "crs" du GeoJSON.
+# Le fichier est lu en flux avec ijson : seul le membre "crs" est construit en mémoire
+def read_crs(f):
+    crs = next(ijson.items(f, "crs", use_float=True), None)
+    if crs is None:
+        # Si le CRS est absent, on suppose qu'il est déjà en WGS 84 (comme le prévoit la RFC 7946)
+        print("CRS inconnu. Supposition : EPSG:4326")
+        return CRS.from_epsg(4326)
+    # Conversion du CRS au format pyproj
+    source_crs = CRS.from_user_input(read_crs_name(crs))
+    print(f"CRS détecté : {source_crs.to_string()}")
+    return source_crs
+
+# Fonction qui lit le type de l'objet GeoJSON et retourne le préfixe ijson de ses entités.
+# Lève une erreur si le fichier n'est ni une FeatureCollection ni une Feature, plutôt que d'exporter des fichiers vides
+def read_features_prefix(f):
+    geojson_type = next(ijson.items(f, "type"), None)
+    if geojson_type not in FEATURE_PREFIXES:
+        raise ValueError(f"Le fichier n'est ni une FeatureCollection ni une Feature GeoJSON (type : {geojson_type})")
+    return FEATURE_PREFIXES[geojson_type]
+
+# Fonction qui indique si une entité donne au moins une ligne :
+# il lui faut une géométrie polygone, ou multipolygone avec au moins une partie non vide
+def has_polygons(feature):
+    geometry = feature.get("geometry") if feature else None
+    if geometry is None:
+        return False
+    if geometry["type"] == "MultiPolygon":
+        return any(rings and rings[0] for rings in geometry["coordinates"])
+    return geometry["type"] == "Polygon"
 
-        # Chargement de toutes les entités du fichier
-        features = list(src)
-    return features, source_crs
+# Fonction qui liste les noms des attributs des entités exportées, dans leur ordre d'apparition.
+# Ils servent d'en-tête au tableau Excel, qui doit être écrit avant les lignes
+# (les entités sont lues en flux, une seule à la fois en mémoire)
+def read_property_names(f, features_prefix):
+    names = {}
+    for feature in ijson.items(f, features_prefix, use_float=True):
+        props = feature.get("properties") if has_polygons(feature) else None
+        if props:
+            names.update(dict.fromkeys(props))
+    return [name for name in names if name not in COMPUTED_COLUMNS]
+
+# Fonction qui lit les entités du GeoJSON en flux, par paquets de CHUNK_SIZE entités,
+# sans jamais charger tout le fichier en mémoire
+def iter_feature_chunks(f, features_prefix):
+    features = ijson.items(f, features_prefix, use_float=True)
+    while chunk := list(islice(features, CHUNK_SIZE)):
+        yield chunk
+
+# Fonction qui extrait les anneaux (ligne extérieure + trous) de chaque polygone
+# d'une géométrie GeoJSON, sous forme de tableaux numpy de coordonnées.
+# Les multipolygones sont éclatés car superset gère mal les multipolygones.
+# Les anneaux vides (sans coordonnées) sont ignorés.
+# Retourne None si la géométrie n'est ni un polygone ni un multipolygone
+def extract_polygon_rings(geometry):
+    if geometry["type"] == "Polygon":
+        # Un polygone sans coordonnées (ou dont l'anneau extérieur est vide) est conservé, comme polygone vide
+        rings = geometry["coordinates"]
+        parts = [rings if rings and rings[0] else []]
+    elif geometry["type"] == "MultiPolygon":
+        # Les parties vides d'un multipolygone sont ignorées
+        parts = [rings for rings in geometry["coordinates"] if rings and rings[0]]
+    else:
+        return None
+    return [[np.asarray(ring, dtype=float)[:, :2] for ring in rings if ring] for rings in parts]
+
+# Fonction qui construit tous les polygones en un seul appel shapely
+# à partir de leurs anneaux, après reprojection groupée des coordonnées
+# (reproject vaut None si aucune reprojection n'est nécessaire)
+def build_polygons(rings_per_polygon, reproject):
+    # Les polygones sans anneau restent des polygones vides
+    polys = np.full(len(rings_per_polygon), Polygon(), dtype=object)
+    rings = [ring for polygon_rings in rings_per_polygon for ring in polygon_rings]
+    if not rings:
+        return polys
+    coords = np.concatenate(rings)
+    if reproject is not None:
+        coords = reproject(coords)
+    ring_indices = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+    polygon_indices = np.repeat(np.arange(len(rings_per_polygon)), [len(r) for r in rings_per_polygon])
+    return shapely.polygons(shapely.linearrings(coords, indices=ring_indices), indices=polygon_indices, out=polys)
 
 # Fonction utilitaire qui compte le nombre total de points d’un polygone
-# (ligne extérieure + éventuels trous à l'intérieur du polygone)
+# (ligne extérieure + éventuels trous à l'intérieur du polygone),
+# le comptage étant fait directement par GEOS sans parcourir les anneaux en Python
 def total_coords_count(geom):
     if isinstance(geom, Polygon):
-        rings = [geom.exterior] + list(geom.interiors)
-        return sum(len(ring.coords) for ring in rings)
+        return int(shapely.get_num_coordinates(geom))
     return 0
 
+# Fonction de recherche dichotomique (sur l'échelle logarithmique), entre low et high, de la plus petite
+# tolérance qui passe sous la cible, arrêtée dès que l'on est à moins de 10 % de la cible.
+# La simplification à la tolérance high est calculée en premier : si elle ne passe pas sous la cible,
+# aucune tolérance de l'intervalle ne le fera et elle est retournée telle quelle
+def search_tolerance(geom, low, high, target_points, max_iterations, preserve_topology):
+    tolerance = high
+    simplified = geom.simplify(tolerance, preserve_topology=preserve_topology)
+    simplified_n = int(shapely.get_num_coordinates(simplified))
+    for _ in range(max_iterations):
+        if simplified_n >= 0.9 * target_points:
+            break
+        candidate_tolerance = math.sqrt(low * high)
+        candidate = geom.simplify(candidate_tolerance, preserve_topology=preserve_topology)
+        candidate_n = int(shapely.get_num_coordinates(candidate))
+        if candidate_n > target_points:
+            low = candidate_tolerance
+        else:
+            high = candidate_tolerance
+            tolerance, simplified, simplified_n = candidate_tolerance, candidate, candidate_n
+        if high / low < 1 + 1e-6:
+            break
+    return simplified, tolerance, simplified_n
+
 # Fonction de simplification adaptative d’un polygone
 # pour réduire le nombre de points sous une limite cible (par ex. 780)
-# utile pour rester sous la limite de caractères d’Excel
-def adaptive_polygon_simplify(geom, target_points=780, max_iterations=300):
-    original = total_coords_count(geom)
+# utile pour rester sous la limite de caractères d’Excel.
+# Le nombre de points d'origine peut être fourni s'il est déjà connu, pour éviter de le recompter
+def adaptive_polygon_simplify(geom, target_points=TARGET_POINTS, max_iterations=50, original=None):
+    if original is None:
+        original = total_coords_count(geom)
 
     # Si déjà assez simple, on garde la géométrie telle quelle
     if original <= target_points:
         return geom, 0.0, original, original
 
-    tolerance = 1e-10  # Tolerance initiale très faible
-    simplified = geom.simplify(tolerance, preserve_topology=True)
-    iteration = 0
+    # La tolérance est encadrée entre une valeur très faible et la diagonale de l'emprise
+    # (qui réduit le polygone au minimum de points)
+    minx, miny, maxx, maxy = geom.bounds
+    diagonal = max(math.hypot(maxx - minx, maxy - miny), 1e-10)
 
-    # Boucle : si geometrie complexe, on augmente la tolérance jusqu’à obtenir une géométrie assez simple
-    while total_coords_count(simplified) > target_points and iteration < max_iterations:
-        error_ratio = total_coords_count(simplified) / target_points
-        tolerance *= min(error_ratio, 2)  # on augmente progressivement
+    if geom.is_valid:
+        # Sur un polygone valide, la recherche utilise d'abord l'algorithme de Douglas-Peucker simple de GEOS,
+        # plusieurs fois plus rapide que la version qui préserve la topologie et qui donne un nombre de points
+        # proche. La simplification finale préserve la topologie, avec la tolérance trouvée
+        _, tolerance, _ = search_tolerance(geom, 1e-10, diagonal, target_points, max_iterations, preserve_topology=False)
         simplified = geom.simplify(tolerance, preserve_topology=True)
-        iteration += 1
+        simplified_n = total_coords_count(simplified)
+
+        # Si elle garde plus de points que la cible, la recherche reprend entre cette tolérance
+        # et la diagonale, en préservant la topologie
+        if simplified_n > target_points:
+            simplified, tolerance, simplified_n = search_tolerance(
+                geom, tolerance, diagonal, target_points, max_iterations, preserve_topology=True)
+    else:
+        # Sur un polygone invalide, GEOS répare le résultat du Douglas-Peucker simple, qui peut alors garder
+        # plus de points que l'original : la recherche préserve directement la topologie
+        simplified, tolerance, simplified_n = search_tolerance(
+            geom, 1e-10, diagonal, target_points, max_iterations, preserve_topology=True)
 
-    simplified_n = total_coords_count(simplified)
     return simplified, tolerance, original, simplified_n
 
-# Fonction principale qui convertit un GeoJSON en fichier Excel et GeoJSON simplifié
-def geojson_to_excel_with_exploded_multipolygons(input_geojson_path, output_excel_path, output_geojson_path):
-    # Lecture du fichier et détection du CRS
-    features, source_crs = read_features_and_crs(input_geojson_path)
+# Fonction qui simplifie un polygone puis sérialise sa géométrie en GeoJSON compact
+# (faite par shapely). Appelée en parallèle par plusieurs threads
+def simplify_and_serialize(poly, n_points):
+    simplified_geom, tol, orig_pts, simp_pts = adaptive_polygon_simplify(poly, original=int(n_points))
+    return shapely.to_geojson(simplified_geom), tol, orig_pts, simp_pts
 
-    # Définition du système de coordonnées cible : EPSG:4326 (WGS 84)
-    target_crs = CRS.from_epsg(4326)
+# Fonction qui crée le fichier Excel avec xlsxwriter en mode "constant_memory" et écrit son en-tête :
+# les lignes sont ensuite écrites dans l'ordre et vidées au fil de l'eau, et les textes (dont les longues
+# géométries) sont écrits directement dans la cellule, sans table de chaînes partagées
+def create_excel_sheet(output, columns):
+    workbook = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        "strings_to_urls": False,  # évite de rechercher des URL dans chaque géométrie
+        "use_zip64": True,
+    })
+    sheet = workbook.add_worksheet("Sheet1")
 
-    # Création du transformateur de coordonnées
-    transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
+    # En-tête en gras, comme avec pandas
+    sheet.write_row(0, 0, columns, workbook.add_format({"bold": True}))
+    return workbook, sheet
 
-    # Fonction interne de reprojection shapely
-    def reproject(geom):
-        return transform(transformer.transform, geom)
+# Fonction qui écrit une ligne du tableau Excel cellule par cellule (write_row s'arrête à la première
+# cellule en erreur et laisse les suivantes vides). Retourne les noms des colonnes dont le texte,
+# plus long que la limite d'une cellule Excel, a été tronqué par xlsxwriter
+def write_excel_row(sheet, row_index, values, columns):
+    truncated = []
+    for col, value in enumerate(values):
+        if sheet.write(row_index, col, value) == -2:
+            truncated.append(columns[col])
+    return truncated
 
-    # Listes pour stocker les lignes Excel et les features simplifiées
-    all_records = []
-    simplified_features = []
+# Fonction qui prépare la valeur d'un attribut pour une cellule Excel :
+# les valeurs imbriquées (objets, listes), non gérées par xlsxwriter, sont écrites en JSON compact
+def excel_value(value):
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value).decode("utf-8")
+    return value
 
-    # Parcours de chaque entité géographique
+# Fonction qui éclate et simplifie un paquet d'entités.
+# Retourne, pour chaque polygone, ses attributs (et leur version sérialisée par orjson)
+# et le résultat de sa simplification (géométrie sérialisée, tolérance, nombres de points)
+def simplify_features(features, reproject, executor):
+    # Parcours de chaque entité géographique pour extraire les anneaux de ses polygones
+    # Les attributs (et leur version sérialisée par orjson) sont récupérés une seule fois
+    # par entité et partagés, sans copie, par tous les polygones issus de son éclatement
+    rings_per_polygon = []
+    polygon_props = []
     for feature in features:
-        props = dict(feature["properties"])  # récupération des attributs
-        geom = shape(feature["geometry"])    # conversion JSON en shapely
-        geom = reproject(geom)               # reprojection vers WGS 84
-
-        # Éclatement des multipolygones en plusieurs polygones car superset gère mal les multipolugones
-        if isinstance(geom, MultiPolygon):
-            polys = list(geom.geoms)
-        elif isinstance(geom, Polygon):
-            polys = [geom]
-        else:
-            # Si ce n’est ni un polygone ni un multipolygone, on ignore
+        # Les entités sans géométrie (géométrie nulle), ni polygone ni multipolygone, sont ignorées
+        if not has_polygons(feature):
             continue
+        polygons_rings = extract_polygon_rings(feature["geometry"])
+        props = dict(feature.get("properties") or {})  # récupération des attributs (éventuellement nuls)
+        rings_per_polygon.extend(polygons_rings)
+        polygon_props.extend([(props, orjson.dumps(props))] * len(polygons_rings))
 
-        # Pour chaque polygone (issu d’un éventuel éclatement)
-        for poly in polys:
-            # Simplification adaptative de la géométrie
-            simplified_geom, tol, orig_pts, simp_pts = adaptive_polygon_simplify(poly)
-
-            # Conversion de la géométrie en format GeoJSON
-            geom_json = mapping(simplified_geom)
-
-            # Création d’une nouvelle entité (feature) simplifiée
-            feature_geojson = {
-                "type": "Feature",
-                "geometry": geom_json,
-                "properties": props
-            }
-            simplified_features.append(feature_geojson)
-
-            # Préparation d’un enregistrement (ligne) pour le tableau Excel
-            record = props.copy()
-            record_geojson = {
-                "type": "Feature",
-                "geometry": geom_json
-            }
-
-            # On stocke la géométrie en texte (format JSON compact) dans une cellule
-            record["geometry"] = json.dumps(record_geojson, ensure_ascii=False, separators=(',', ':'))
-
-            # Ajout d’une colonne pour suivre le niveau de simplification
-            record["simplification_info"] = (
-                f"{orig_pts}→{simp_pts} points (tolérance={tol:.0e})"
-                if tol > 0 else "Aucune simplification"
-            )
-
-            # Ajout de la ligne au tableau final
-            all_records.append(record)
-
-    # Export final du tableau vers un fichier Excel
-    df = pd.DataFrame(all_records)
-    df.to_excel(output_excel_path, index=False)
-    print(f"Excel exporté : {output_excel_path}")
+    # Construction groupée de tous les polygones, reprojetés vers WGS 84
+    polys = build_polygons(rings_per_polygon, reproject)
+
+    # La géométrie n'est sérialisée qu'une fois, pour le GeoJSON simplifié et pour Excel.
+    # Tous les polygones sont sérialisés en un seul appel shapely : ceux dont la géométrie
+    # tient déjà dans une cellule Excel sont gardés tels quels, sans passer par la simplification
+    point_counts = shapely.get_num_coordinates(polys)
+    geom_strs = shapely.to_geojson(polys)
+    small = np.fromiter(map(len, geom_strs), dtype=np.int64, count=len(geom_strs)) <= MAX_GEOMETRY_CHARS
+    results = [None] * len(polys)
+    for k in np.flatnonzero(small):
+        results[k] = (geom_strs[k], 0.0, point_counts[k], point_counts[k])
+
+    # Simplification adaptative et sérialisation des autres polygones en parallèle :
+    # shapely libère le GIL pendant les calculs GEOS, des threads suffisent
+    large = np.flatnonzero(~small)
+    for k, result in zip(large, executor.map(simplify_and_serialize, polys[large], point_counts[large])):
+        results[k] = result
+
+    return zip(polygon_props, results)
+
+# Fonction principale qui convertit un GeoJSON en fichier Excel et GeoJSON simplifié
+def geojson_to_excel_with_exploded_multipolygons(input_geojson_path, output_excel_path, output_geojson_path):
+    with open(input_geojson_path, "rb") as f:
+        # Lecture en flux du type d'objet GeoJSON et du CRS, puis des noms d'attributs pour l'en-tête du tableau Excel
+        features_prefix = read_features_prefix(f)
+        f.seek(0)
+        source_crs = read_crs(f)
+        f.seek(0)
+        property_names = read_property_names(f, features_prefix)
+        f.seek(0)
+
+        # Définition du système de coordonnées cible : EPSG:4326 (WGS 84)
+        target_crs = CRS.from_epsg(4326)
+
+        # Si les données sont déjà en WGS 84, aucune reprojection n'est nécessaire
+        # (y compris en CRS84, qui ne diffère d'EPSG:4326 que par l'ordre des axes)
+        if source_crs.equals(target_crs, ignore_axis_order=True):
+            reproject = None
+        else:
+            # Création du transformateur de coordonnées
+            transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+            # Fonction interne de reprojection : toutes les coordonnées sont envoyées
+            # en un seul appel à PROJ (et non point par point)
+            def reproject(coords):
+                x, y = transformer.transform(coords[:, 0], coords[:, 1])
+                return np.column_stack([x, y])
+
+        # Tableau Excel : attributs, géométrie en texte (format JSON compact)
+        # et suivi du niveau de simplification
+        columns = property_names + COMPUTED_COLUMNS
+        workbook, sheet = create_excel_sheet(output_excel_path, columns)
+
+        # Les entités sont lues, simplifiées et écrites paquet par paquet : le GeoJSON simplifié
+        # (sans indentation) et le tableau Excel sont écrits au fil de l'eau
+        with open(output_geojson_path, "wb") as geojson_file, \
+                ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            geojson_file.write(b'{"type":"FeatureCollection","features":[')
+            n_rows = 0
+
+            for features in iter_feature_chunks(f, features_prefix):
+                # Pour chaque polygone (issu d’un éventuel éclatement)
+                for (props, props_json), (geom_str, tol, orig_pts, simp_pts) in simplify_features(features, reproject, executor):
+                    # Ligne du tableau Excel, préparée avant toute écriture pour que les deux fichiers
+                    # restent alignés (les attributs absents donnent des cellules vides)
+                    row = [excel_value(props.get(name)) for name in property_names] + [
+                        '{"type":"Feature","geometry":' + geom_str + '}',
+                        f"{orig_pts}→{simp_pts} points (tolérance={tol:.0e})"
+                        if tol > 0 else "Aucune simplification",
+                    ]
 
-    # Export du GeoJSON simplifié vers un fichier
-    final_geojson = {
-        "type": "FeatureCollection",
-        "features": simplified_features
-    }
-    with open(output_geojson_path, "w", encoding="utf-8") as f:
-        json.dump(final_geojson, f, ensure_ascii=False, indent=2)
+                    # Écriture directe de la nouvelle entité (feature) simplifiée dans le GeoJSON,
+                    # à partir de la géométrie et des propriétés déjà sérialisées
+                    if n_rows > 0:
+                        geojson_file.write(b",")
+                    geojson_file.write(b'{"type":"Feature","geometry":' + geom_str.encode("utf-8")
+                                       + b',"properties":' + props_json + b'}')
+
+                    # Ajout de la ligne au tableau Excel
+                    n_rows += 1
+                    truncated = write_excel_row(sheet, n_rows, row, columns)
+                    if truncated:
+                        print(f"Ligne {n_rows} : texte tronqué à {EXCEL_CELL_MAX_CHARS} caractères "
+                              f"(colonnes : {', '.join(truncated)})")
+
+            geojson_file.write(b']}')
     print(f"GeoJSON simplifié exporté : {output_geojson_path}")
 
+    workbook.close()
+    print(f"Excel exporté : {output_excel_path}")
+
 # chemins des fichiers
 if __name__ == "__main__":
     geojson_to_excel_with_exploded_multipolygons(